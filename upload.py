@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 
 import configargparse
-import shutil
-import tempfile
-import urllib.request
 from urllib.parse import urlparse
-import json
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
+import sys
+import re
 import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from collections import namedtuple, Counter
 from http import HTTPStatus
+from enum import Enum
+
+try:
+    import orjson as json_parser
+except ImportError:
+    import json as json_parser
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
 
 DEFAULT_CONFIG_FILE = 'config.yaml'
 
+logger = logging.getLogger(__name__)
+
 parser = configargparse.ArgumentParser(
     formatter_class=configargparse.ArgumentDefaultsHelpFormatter,
     default_config_files=['config.yaml'],
@@ -81,6 +97,22 @@ parser.add_argument(
     dest='logging_freq',
     default=None)
 
+parser.add_argument(
+    '--workers', '-w',
+    action='store',
+    type=int,
+    help='Number of files registered concurrently.',
+    dest='workers',
+    default=32)
+
+parser.add_argument(
+    '--checkpoint-file', '-cf',
+    action='store',
+    help='Path to file in which successfully registered files are recorded. Files already recorded in it are '
+         'skipped, so an interrupted registration can be resumed.',
+    dest='checkpoint_file',
+    default=None)
+
 parser.add_argument(
     '--disable-cert-verification', '-dv',
     action='store_true',
@@ -98,9 +130,34 @@ parser.add_argument(
 
 
 REGISTER_FILE_ENDPOINT = "https://{0}/api/v3/oneprovider/data/register"
+# number of registrations kept in flight per worker
+PENDING_PER_WORKER = 2
+SERVER_URL_PREFIX = re.compile(r'[a-zA-Z][a-zA-Z0-9+.-]*://[^/?#]*')
+# characters for which urlparse does more than split off scheme and netloc
+URLPARSE_SPECIAL_CHARS = re.compile(r'[?#;\t\r\n]')
+
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RETRY_METHODS = frozenset(['GET', 'POST'])
+
+FileSpec = namedtuple('FileSpec', ['uri', 'size', 'checksum'])
+Registration = namedtuple('Registration', [
+    'url', 'headers', 'base_payload', 'verify', 'space_id', 'registered_files', 'checkpoint'])
+
+
+class RegistrationResult(Enum):
+    REGISTERED = 'registered'
+    SKIPPED = 'skipped'
+    FAILED = 'failed'
+
+
+SESSION = requests.Session()
+CHECKPOINT_LOCK = threading.Lock()
 
 
 def strip_server_url(storage_file_id):
+    match = SERVER_URL_PREFIX.match(storage_file_id)
+    if match and not URLPARSE_SPECIAL_CHARS.search(storage_file_id):
+        return storage_file_id[match.end():]
     parsed_url = urlparse(storage_file_id)
     if parsed_url.scheme:
         return parsed_url.path
@@ -108,93 +165,195 @@ def strip_server_url(storage_file_id):
         return storage_file_id
 
 
-def register_file(storage_file_id, size, checksum):
-    headers = {
-        'X-Auth-Token': args.token,
-        "content-type": "application/json"
-    }
+def create_retry():
+    retry_args = dict(total=5, backoff_factor=0.5, status_forcelist=RETRY_STATUSES, raise_on_status=False)
+    try:
+        return Retry(allowed_methods=RETRY_METHODS, **retry_args)
+    except TypeError:
+        # urllib3 < 1.26
+        return Retry(method_whitelist=RETRY_METHODS, **retry_args)
+
+
+def load_checkpoint(checkpoint_file, space_id):
+    if not checkpoint_file or not os.path.exists(checkpoint_file):
+        return set()
+    registered_files = set()
+    with open(checkpoint_file, 'r') as f:
+        for line in f:
+            if line.strip():
+                entry_space_id, storage_file_id = line.rstrip('\n').split('\t', 1)
+                if entry_space_id == space_id:
+                    registered_files.add(storage_file_id)
+    return registered_files
+
+
+def save_checkpoint(registration, storage_file_id):
+    with CHECKPOINT_LOCK:
+        registration.checkpoint.write('{0}\t{1}\n'.format(registration.space_id, storage_file_id))
+        registration.checkpoint.flush()
+
+
+def create_registration(args, checkpoint):
+    return Registration(
+        url=REGISTER_FILE_ENDPOINT.format(args.host),
+        headers={
+            'X-Auth-Token': args.token,
+            "content-type": "application/json"
+        },
+        base_payload={
+            'spaceId': args.space_id,
+            'storageId': args.storage_id,
+            'mode': args.mode,
+            'autoDetectAttributes': not args.disable_auto_detection
+        },
+        verify=not args.disable_cert_verification,
+        space_id=args.space_id,
+        registered_files=load_checkpoint(args.checkpoint_file, args.space_id),
+        checkpoint=checkpoint)
+
+
+def register_file(registration, storage_file_id, size, checksum):
     storage_file_id = strip_server_url(storage_file_id)
+    if storage_file_id in registration.registered_files:
+        return RegistrationResult.SKIPPED
     payload = {
-        'spaceId': args.space_id,
-        'storageId': args.storage_id,
+        **registration.base_payload,
         'storageFileId': storage_file_id,
         'destinationPath': storage_file_id,
         'size': size,
-        'mode': args.mode,
         'xattrs': {
             'checksum': checksum
-        },
-        'autoDetectAttributes': not args.disable_auto_detection
+        }
     }
     try:
-        response = requests.post(REGISTER_FILE_ENDPOINT.format(args.host), json=payload, headers=headers, verify=(not args.disable_cert_verification))
+        response = SESSION.post(registration.url, data=json_parser.dumps(payload), headers=registration.headers,
+                                verify=registration.verify)
         if response.status_code == HTTPStatus.CREATED:
-            return True
+            if registration.checkpoint:
+                save_checkpoint(registration, storage_file_id)
+            return RegistrationResult.REGISTERED
         else:
-            logging.error("Registration of {0} failed with HTTP status {1}.\n""Response: {2}"
-                          .format(storage_file_id, response.status_code, response.content)),
-            return False
+            logger.error("Registration of %s failed with HTTP status %s.\nResponse: %s",
+                         storage_file_id, response.status_code, response.content)
+            return RegistrationResult.FAILED
     except Exception as e:
-        logging.error("Registration of {0} failed due to {1}".format(storage_file_id, e), exc_info=True)
+        logger.error("Registration of %s failed due to %s", storage_file_id, e, exc_info=True)
+        return RegistrationResult.FAILED
 
 
 def download_and_load_json(url):
-    with urllib.request.urlopen(url) as response:
-        with tempfile.NamedTemporaryFile(delete=True) as tmp_file:
-            shutil.copyfileobj(response, tmp_file)
-            tmp_file.flush()
-            with open(tmp_file.name, 'r') as f:
-                return json.load(f)
+    response = SESSION.get(url)
+    response.raise_for_status()
+    return json_parser.loads(response.content)
+
+
+def iterate_json_array(url):
+    with SESSION.get(url, stream=True) as response:
+        response.raise_for_status()
+        if ijson:
+            response.raw.decode_content = True
+            yield from ijson.items(response.raw, 'item')
+        else:
+            yield from json_parser.loads(response.content)
 
 
 def get_files_and_json_indexes_urls(collection_url):
     collection = download_and_load_json(collection_url)
-    index_urls = []
-    txt_urls = []
-    for index_spec in collection["metadata"]["index_files"]:
-        index_url = index_spec['uri_http']
-        [_, ext] = os.path.splitext(index_url)
-        if ext == ".json":
-            index_urls.append(index_url)
-        elif ext == ".txt":
-            txt_urls.append(txt_urls)
+    index_urls = [index_spec['uri_http'] for index_spec in collection["metadata"]["index_files"]
+                  if index_spec['uri_http'].endswith(".json")]
     return collection["metadata"]["files"], index_urls
 
 
-def register_files_from_index(index_url):
-    file_specs = download_and_load_json(index_url)
-    size_sum = 0
-    count = 0
-    for i, file_spec in enumerate(file_specs):
-        if args.logging_freq and i % args.logging_freq == 0 and i > 0:
-            print("Registered {0} files".format(i))
-        if register_file(file_spec['uri'], file_spec['size'], file_spec['checksum']):
-            size_sum += file_spec['size']
-            count += 1
-    return size_sum, count
+def iterate_file_specs(collection_urls, failed_indexes):
+    for collection_url in collection_urls:
+        print("Processing collection {0}".format(collection_url))
+        file_specs, index_urls = get_files_and_json_indexes_urls(collection_url)
 
+        if file_specs:
+            print("Registering files")
+        for file_spec in file_specs:
+            yield FileSpec(file_spec['uri_root'], file_spec['size'], file_spec['checksum'])
 
-args = parser.parse_args()
-total_size = 0
-total_count = 0
+        for index_url in index_urls:
+            print("Registering files from index {0}".format(index_url))
+            try:
+                for file_spec in iterate_json_array(index_url):
+                    yield FileSpec(file_spec['uri'], file_spec['size'], file_spec['checksum'])
+            except Exception as e:
+                logger.error("Reading of index %s failed due to %s. "
+                             "Remaining files from this index were not registered.", index_url, e, exc_info=True)
+                failed_indexes.append(index_url)
 
-for collection_url in args.collections:
-    print("Processing collection {0}".format(collection_url))
-    file_specs, index_urls = get_files_and_json_indexes_urls(collection_url)
 
-    if file_specs:
-        print("Registering files")
+def register_files(executor, registration, file_specs, max_pending, logging_freq):
+    size_sum = 0
+    counts = Counter()
+    processed = 0
+    pending = {}
+
+    def collect_completed():
+        nonlocal size_sum, processed
+        done, _ = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            file_spec = pending.pop(future)
+            processed += 1
+            if logging_freq and processed % logging_freq == 0:
+                print("Registered {0} files".format(processed))
+            result = future.result()
+            counts[result] += 1
+            if result is RegistrationResult.REGISTERED:
+                size_sum += file_spec.size
 
     for file_spec in file_specs:
-        if register_file(file_spec['uri_root'], file_spec['size'], file_spec['checksum']):
-            total_size += file_spec['size']
-            total_count += 1
-
-    for index_url in index_urls:
-        print("Registering files from index {0}".format(index_url))
-        size_sum, count = register_files_from_index(index_url)
-        total_size += size_sum
-        total_count += count
-
-print("\nTotal registered files count: {0}".format(total_count))
-print("Total size: {0}".format(total_size))
+        pending[executor.submit(register_file, registration, *file_spec)] = file_spec
+        if len(pending) >= max_pending:
+            collect_completed()
+    while pending:
+        collect_completed()
+    return size_sum, counts
+
+
+def main():
+    args = parser.parse_args()
+    # collections and indexes are usually served over plain http, registration goes to the Oneprovider host
+    # over https; both adapters keep pools for two hosts in case indexes are served from another host
+    for prefix in ('https://', 'http://'):
+        SESSION.mount(prefix, HTTPAdapter(
+            pool_connections=2,
+            pool_maxsize=args.workers,
+            max_retries=create_retry()))
+    checkpoint = open(args.checkpoint_file, 'a') if args.checkpoint_file else None
+    registration = create_registration(args, checkpoint)
+    if registration.registered_files:
+        print("Loaded {0} checkpoint entries for space {1} from {2}"
+              .format(len(registration.registered_files), args.space_id, args.checkpoint_file))
+    failed_indexes = []
+    try:
+        # files from all collections and indexes go through a single pipeline, so the next index is
+        # downloaded while registrations of the previous one are still in flight
+        with ThreadPoolExecutor(max_workers=args.workers) as executor:
+            total_size, counts = register_files(
+                executor,
+                registration,
+                iterate_file_specs(args.collections, failed_indexes),
+                PENDING_PER_WORKER * args.workers,
+                args.logging_freq)
+    finally:
+        if checkpoint:
+            checkpoint.close()
+
+    print("\nTotal registered files count: {0}".format(counts[RegistrationResult.REGISTERED]))
+    print("Total size: {0}".format(total_size))
+    if args.checkpoint_file:
+        print("Total skipped files count: {0}".format(counts[RegistrationResult.SKIPPED]))
+    print("Total failed files count: {0}".format(counts[RegistrationResult.FAILED]))
+    print("Indexes not read completely: {0}".format(len(failed_indexes)))
+    for index_url in failed_indexes:
+        print("  {0}".format(index_url))
+
+    if counts[RegistrationResult.FAILED] or failed_indexes:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()